@@ -1,15 +1,31 @@
 import calendar
+import contextlib
+import csv
+import io
+import json
+import os
 import re
 import smtplib
+import sqlite3
+import tempfile
+import threading
 import time
-from datetime import datetime
+import uuid
+from datetime import datetime, timezone
 from email.message import EmailMessage
+from types import MappingProxyType
+from typing import Mapping, NamedTuple
 
 import gspread
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import requests
 import streamlit as st
 from PIL import Image
+from google.auth.transport.requests import AuthorizedSession, Request
 from google.oauth2.service_account import Credentials
+from requests.adapters import HTTPAdapter
 
 st.set_page_config(page_title="Tumble Cup", page_icon="🥤", layout="centered")
 
@@ -17,6 +33,17 @@ SCOPES = [
     "https://www.googleapis.com/auth/spreadsheets",
     "https://www.googleapis.com/auth/drive"
 ]
+
+ORDERS_SHEET_NAME = "Tumble_cup"
+STOCK_SHEET_NAME = "Stock"
+PRODUCTS_SHEET_NAME = "Products"
+CATALOG_CHECK_INTERVAL = 60  # Seconds between revision checks of the spreadsheet
+HTTP_POOL_SIZE = 10  # Keep-alive connections kept open per Google API host
+TOKEN_REFRESH_MARGIN = 300  # Refresh the access token this many seconds before it expires
+TOKEN_REFRESH_RETRY = 30  # Seconds to wait before retrying a failed background refresh
+STOCK_SYNC_INTERVAL = 60  # Seconds between reconciliations with the Stock sheet
+SNAPSHOT_MAX_AGE = 30  # Seconds a cached sheet snapshot is trusted, to pick up edits made in Sheets
+SHARED_LOCK_LEASE = 60  # Seconds before a cross-process lock left by a crashed replica expires
 creds_dict = {
     "type": st.secrets["connections"]["gsheets"]["type"],
     "project_id": st.secrets["connections"]["gsheets"]["project_id"],
@@ -31,33 +58,138 @@ creds_dict = {
 }
 
 
+class SheetsSession:
+    """Keep-alive, connection-pooled session for Google APIs with background token refresh
+
+    Once start_background_refresh() is called, access tokens are refreshed on a daemon thread
+    TOKEN_REFRESH_MARGIN seconds before they expire, so requests never wait on a refresh inline.
+    """
+
+    def __init__(self, creds):
+        self.creds = creds
+
+        token_session = requests.Session()
+        token_session.mount("https://", HTTPAdapter(pool_maxsize=1))
+        self._auth_request = Request(token_session)
+
+        self.session = AuthorizedSession(creds, auth_request=self._auth_request)
+        self._adapter = HTTPAdapter(pool_maxsize=HTTP_POOL_SIZE)
+        self.session.mount("https://", self._adapter)
+
+        self._refresh_lock = threading.Lock()
+        self.refresh_count = 0
+        self.last_refresh_seconds = None
+        self.last_refresh_at = None
+        self.last_refresh_error = None
+
+        # Fetch the first token while the app is connecting rather than on the first request.
+        # A failure here is left to the background thread, which retries while there is no token.
+        try:
+            self.refresh()
+        except Exception as e:
+            self.last_refresh_error = str(e)
+
+    def start_background_refresh(self):
+        """Start refreshing the token on a daemon thread; call once the client using it is built"""
+        threading.Thread(target=self._refresh_loop, name="sheets-token-refresh", daemon=True).start()
+
+    def refresh(self):
+        """Refresh the access token and record how long it took"""
+        with self._refresh_lock:
+            started = time.perf_counter()
+            self.creds.refresh(self._auth_request)
+            self.last_refresh_seconds = time.perf_counter() - started
+            self.last_refresh_at = datetime.now()
+            self.refresh_count += 1
+
+    def _seconds_until_refresh(self):
+        if not self.creds.token or self.creds.expiry is None:
+            return 0
+        # google-auth stores expiry as a naive UTC datetime
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        return (self.creds.expiry - now).total_seconds() - TOKEN_REFRESH_MARGIN
+
+    def _refresh_loop(self):
+        while True:
+            delay = self._seconds_until_refresh()
+            if delay > 0:
+                time.sleep(delay)
+                continue
+
+            try:
+                self.refresh()
+                self.last_refresh_error = None
+            except Exception as e:
+                self.last_refresh_error = str(e)
+            # Also wait after a success, or a token without a usable expiry is refreshed non-stop
+            time.sleep(max(TOKEN_REFRESH_RETRY, self._seconds_until_refresh()))
+
+    def metrics(self):
+        """Connection reuse and token refresh statistics"""
+        request_count = 0
+        connection_count = 0
+        pools = self._adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            request_count += pool.num_requests
+            connection_count += pool.num_connections
+
+        return {
+            "Requests": request_count,
+            "New Connections": connection_count,
+            "Reused Connections": max(0, request_count - connection_count),
+            "Token Refreshes": self.refresh_count,
+            "Last Refresh (ms)": round(self.last_refresh_seconds * 1000) if self.last_refresh_seconds else None,
+            "Last Refresh At": self.last_refresh_at.strftime("%H:%M:%S") if self.last_refresh_at else None,
+            "Next Refresh In (s)": max(0, round(self._seconds_until_refresh())),
+            "Last Refresh Error": self.last_refresh_error
+        }
+
+
 @st.cache_resource(show_spinner="Connecting to Google Sheets...")
 def init_gspread_connection():
-    """Initialize gspread connection with service account credentials"""
-    try:
-        # creds = Credentials.from_service_account_file("Credentials.json", scopes=SCOPES)
-        creds = Credentials.from_service_account_info(creds_dict, scopes=SCOPES)
+    """Initialize gspread connection with service account credentials
+
+    Raises on failure, since st.cache_resource does not cache exceptions and the next run retries.
+    """
+    # creds = Credentials.from_service_account_file("Credentials.json", scopes=SCOPES)
+    creds = Credentials.from_service_account_info(creds_dict, scopes=SCOPES)
+
+    sheets_session = SheetsSession(creds)
+    # gspread 5.x's authorize() takes no session, but Client(auth, session) works on 5.x and 6.x
+    gs_client = gspread.Client(auth=creds, session=sheets_session.session)
+    sheets_session.start_background_refresh()
+    return gs_client, sheets_session
+
 
-        gs_client = gspread.authorize(creds)
-        return gs_client
+def connect_gspread():
+    """Return the cached gspread client and session, or (None, None) for this run if connecting failed"""
+    try:
+        return init_gspread_connection()
     except Exception as e:
         st.error(f"❌ Failed to initialize Google Sheets connection: {e}")
-        return None
+        return None, None
 
 
 # Cached gspread client
-gc = init_gspread_connection()
+gc, sheets_session = connect_gspread()
+
 
+def get_worksheet(sheet_name=ORDERS_SHEET_NAME, show_errors=True):
+    """Get the worksheet object from the Google Sheet
 
-def get_worksheet():
-    """Get the worksheet object from the Google Sheet"""
+    With show_errors=False failures are raised rather than drawn on the page, for background
+    work that runs inside whichever customer's rerun happens to trigger it.
+    """
     try:
         if gc is None:
+            if not show_errors:
+                raise RuntimeError("Google Sheets client is not initialized")
             st.warning("Google Sheets client is not initialized.")
             return None
 
         SPREADSHEET_ID = st.secrets["connections"]["gsheets"]["spreadsheet"]
-        SHEET_NAME = "Tumble_cup"
+        SHEET_NAME = sheet_name
 
         spreadsheet = gc.open_by_key(SPREADSHEET_ID)
         worksheet = spreadsheet.worksheet(SHEET_NAME)
@@ -65,11 +197,291 @@ def get_worksheet():
         return worksheet
 
     except Exception as e:
+        if not show_errors:
+            raise
         st.error(f"❌ Failed to access worksheet '{SHEET_NAME}': {e}")
         return None
 
 
-tumbler_items = {
+class SharedCache:
+    """File-backed cache shared by every app replica on the host
+
+    Worksheet snapshots are stored with the sheet version they were read at. Writing to a
+    sheet bumps its version, which invalidates the snapshot for every replica at once.
+    Counters such as the order-number high-water mark are updated atomically.
+
+    The database runs in WAL mode, which needs a local disk: it coordinates processes on one
+    host only and must not be placed on a network filesystem. Replicas on separate hosts or
+    containers each get their own cache, so anything that must be unique across them (order
+    numbers, row IDs) is also checked against a fresh read of the sheet.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS snapshots "
+                         "(name TEXT PRIMARY KEY, version INTEGER NOT NULL, stored_at REAL NOT NULL, value TEXT NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS locks "
+                         "(name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)")
+
+    @contextlib.contextmanager
+    def _connect(self):
+        """Open a connection that commits on success and is always closed"""
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def version(self, name):
+        """Return the current version of a cached sheet"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT version FROM versions WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+
+    def invalidate(self, name):
+        """Bump a sheet's version so every replica drops its snapshot"""
+        with self._connect() as conn:
+            conn.execute("INSERT INTO versions (name, version) VALUES (?, 1) "
+                         "ON CONFLICT(name) DO UPDATE SET version = version + 1", (name,))
+
+    def get_snapshot(self, name, version, max_age):
+        """Return a snapshot taken at the given version and younger than max_age seconds, else None"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT value FROM snapshots WHERE name = ? AND version = ? AND stored_at >= ?",
+                               (name, version, time.time() - max_age)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_snapshot(self, name, version, value):
+        """Store a snapshot read while the sheet was at the given version"""
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO snapshots (name, version, stored_at, value) VALUES (?, ?, ?, ?)",
+                         (name, version, time.time(), json.dumps(value)))
+
+    @contextlib.contextmanager
+    def lock(self, name, lease=SHARED_LOCK_LEASE):
+        """Try to take a cross-process lock without waiting; yields whether it was acquired
+
+        The lock is a lease, so one left behind by a crashed replica expires after `lease` seconds.
+        """
+        owner = uuid.uuid4().hex
+        with self._connect() as conn:
+            conn.execute("DELETE FROM locks WHERE name = ? AND expires_at < ?", (name, time.time()))
+            acquired = conn.execute("INSERT OR IGNORE INTO locks (name, owner, expires_at) VALUES (?, ?, ?)",
+                                    (name, owner, time.time() + lease)).rowcount == 1
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                with self._connect() as conn:
+                    conn.execute("DELETE FROM locks WHERE name = ? AND owner = ?", (name, owner))
+
+    def next_counter(self, name, floor=0):
+        """Atomically advance a counter past max(current value, floor) and return it"""
+        with self._connect() as conn:
+            row = conn.execute("INSERT INTO counters (name, value) VALUES (?, ? + 1) "
+                               "ON CONFLICT(name) DO UPDATE SET value = MAX(value, excluded.value - 1) + 1 "
+                               "RETURNING value", (name, floor)).fetchone()
+        return row[0]
+
+
+@st.cache_resource
+def get_shared_cache():
+    """Open the shared cache on local disk; [Cache] Path in secrets overrides the location
+
+    Only processes that see the same local file share it, see SharedCache.
+    """
+    default_path = os.path.join(tempfile.gettempdir(), "tumblecup_cache.sqlite3")
+    return SharedCache(st.secrets.get("Cache", {}).get("Path", default_path))
+
+
+shared_cache = get_shared_cache()
+
+
+def get_sheet_values(sheet_name=ORDERS_SHEET_NAME, fresh=False):
+    """Return all values of a worksheet, served from the shared cache while it is current
+
+    fresh=True always reads the sheet (and refreshes the snapshot), for values that must not
+    be stale such as the next order number.
+    """
+    version = shared_cache.version(sheet_name)
+    if not fresh:
+        values = shared_cache.get_snapshot(sheet_name, version, SNAPSHOT_MAX_AGE)
+        if values is not None:
+            return values
+
+    worksheet = get_worksheet(sheet_name)
+    if worksheet is None:
+        return None
+
+    values = worksheet.get_all_values()
+    shared_cache.put_snapshot(sheet_name, version, values)
+    return values
+
+
+class StockLedger:
+    """In-process stock counters, reconciled with the Stock worksheet in coalesced writes
+
+    The Stock sheet has "Item Name", "Item Style" and "Stock" columns. Items that are
+    not listed there are not tracked and never run out.
+
+    Each replica keeps its own counters, so they are only exact within one sync interval:
+    reservations made on other replicas since the last sync are not seen until the next one.
+    The sync itself runs under a cross-process lock so replicas never overwrite each other.
+    Nothing can be reserved until the first successful sync has loaded the counters (`ready`).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._available = {}  # (item, style) -> units available right now
+        self._pending = {}  # (item, style) -> units reserved since the last sync
+        self._last_sync = None
+        self.ready = False
+        self.last_error = None
+
+    def available(self, item_name, style):
+        """Return the units available for an item/style, or None if it is not tracked"""
+        with self._lock:
+            return self._available.get((item_name, style))
+
+    def reserve(self, items):
+        """Atomically reserve (item, style, quantity) lines; reserve all or nothing
+
+        Returns a list of (item, style, available) shortfalls, empty on success.
+        """
+        with self._lock:
+            if not self.ready:
+                # Untracked-looking items would otherwise be sold without ever reaching the sheet
+                raise RuntimeError("stock levels have not been loaded yet")
+
+            shortfalls = []
+            for item_name, style, quantity in items:
+                available = self._available.get((item_name, style))
+                if available is not None and available < quantity:
+                    shortfalls.append((item_name, style, available))
+            if shortfalls:
+                return shortfalls
+
+            for item_name, style, quantity in items:
+                key = (item_name, style)
+                if key in self._available:
+                    self._available[key] -= quantity
+                    self._pending[key] = self._pending.get(key, 0) + quantity
+            return []
+
+    def release(self, items):
+        """Return previously reserved (item, style, quantity) lines to stock"""
+        with self._lock:
+            for item_name, style, quantity in items:
+                key = (item_name, style)
+                if key in self._available:
+                    self._available[key] += quantity
+                    self._pending[key] = self._pending.get(key, 0) - quantity
+
+    def sync(self, force=False):
+        """Reconcile counters with the Stock sheet if the sync interval has passed
+
+        Reservations made since the last sync are written back in a single batch update,
+        and counters pick up any restocking done directly in the sheet.
+        """
+        if not force and self._last_sync is not None and time.monotonic() - self._last_sync < STOCK_SYNC_INTERVAL:
+            return
+        if not self._sync_lock.acquire(blocking=False):
+            return  # Another session is already syncing
+
+        try:
+            with shared_cache.lock("stock_sync") as acquired:
+                if not acquired and self.ready:
+                    return  # Another replica is syncing; try again on the next run
+                # Before the first sync nothing can be pending, so loading without the lock writes nothing
+
+                with self._lock:
+                    pending, self._pending = self._pending, {}
+
+                try:
+                    sheet_stock = self._write_pending(pending)
+                except Exception:
+                    # Keep the unsynced reservations so the next sync retries them
+                    with self._lock:
+                        for key, quantity in pending.items():
+                            self._pending[key] = self._pending.get(key, 0) + quantity
+                    raise
+
+                with self._lock:
+                    # Reservations made while the sheet was being updated are still pending
+                    self._available = {key: stock - self._pending.get(key, 0) for key, stock in sheet_stock.items()}
+                self._last_sync = time.monotonic()
+                self.ready = True
+                self.last_error = None
+
+        except Exception as e:
+            # Shown to admins in the sidebar rather than to the shopper whose rerun ran the sync
+            self.last_error = str(e)
+            self._last_sync = time.monotonic()
+        finally:
+            self._sync_lock.release()
+
+    def _write_pending(self, pending):
+        """Read the Stock sheet, subtract pending reservations and write the changed rows back"""
+        try:
+            worksheet = get_worksheet(STOCK_SHEET_NAME, show_errors=False)
+        except gspread.exceptions.WorksheetNotFound:
+            return {}  # No Stock sheet, so no item is tracked
+
+        raw_data = worksheet.get_all_values()
+        if not raw_data:
+            return {}
+
+        headers = raw_data[0]
+        item_col = headers.index("Item Name")
+        style_col = headers.index("Item Style")
+        stock_col = headers.index("Stock")
+
+        sheet_stock = {}
+        updates = []
+        for row_number, row in enumerate(raw_data[1:], start=2):
+            row = row + [''] * (len(headers) - len(row))
+            try:
+                stock = int(row[stock_col])
+            except ValueError:
+                continue
+
+            key = (row[item_col], row[style_col])
+            if pending.get(key):
+                stock = max(0, stock - pending[key])
+                updates.append({
+                    "range": gspread.utils.rowcol_to_a1(row_number, stock_col + 1),
+                    "values": [[stock]]
+                })
+            sheet_stock[key] = stock
+
+        if updates:
+            # Refuse to write absolute values over changes made since the read above, such as
+            # a restock typed into the sheet; the next sync starts again from fresh values
+            if worksheet.get_all_values() != raw_data:
+                raise RuntimeError(f"worksheet '{STOCK_SHEET_NAME}' changed during sync, will retry")
+            worksheet.batch_update(updates)
+
+        return sheet_stock
+
+
+@st.cache_resource
+def get_stock_ledger():
+    """Shared stock ledger for every session in this process"""
+    return StockLedger()
+
+
+stock_ledger = get_stock_ledger()
+stock_ledger.sync()
+
+
+# Built-in catalog, used until the Products sheet has been read successfully
+default_tumbler_items = {
     "Classic Tumbler": {
         "price": 3999,
         "styles": ["Style 1", "Style 2", "Style 3", "Style 4", "Custom", "Hand Painted"]
@@ -87,6 +499,149 @@ tumbler_items = {
 CUSTOM_FEE = 250
 HANDPAINTED_FEE = 500
 
+
+class Catalog(NamedTuple):
+    """Read-only product catalog with prices precomputed for every item/style"""
+    items: Mapping  # item name -> {"price", "styles", "custom_fee", "handpainted_fee"}
+    prices: Mapping  # (item name, style) -> unit price including the style fee
+    fees: Mapping  # (item name, style) -> style fee included in the unit price
+
+
+def build_catalog(items):
+    """Freeze catalog items and precompute the item/style price table"""
+    frozen_items = {}
+    prices = {}
+    fees = {}
+    for item_name, item_info in items.items():
+        custom_fee = item_info.get('custom_fee', CUSTOM_FEE)
+        handpainted_fee = item_info.get('handpainted_fee', HANDPAINTED_FEE)
+        frozen_items[item_name] = MappingProxyType({
+            'price': item_info['price'],
+            'styles': tuple(item_info['styles']),
+            'custom_fee': custom_fee,
+            'handpainted_fee': handpainted_fee
+        })
+
+        for style in item_info['styles']:
+            if style == "Custom":
+                style_fee = custom_fee
+            elif style == "Hand Painted":
+                style_fee = handpainted_fee
+            else:
+                style_fee = 0
+            fees[(item_name, style)] = style_fee
+            prices[(item_name, style)] = item_info['price'] + style_fee
+
+    return Catalog(MappingProxyType(frozen_items), MappingProxyType(prices), MappingProxyType(fees))
+
+
+def parse_products(raw_data):
+    """Parse Products sheet rows: Item Name, Price, Styles (comma separated) and optional fee columns"""
+    headers = raw_data[0]
+    items = {}
+    for row in raw_data[1:]:
+        record = dict(zip(headers, row))
+        item_name = record.get("Item Name", "").strip()
+        if not item_name:
+            continue
+
+        item_info = {
+            'price': int(record["Price"]),
+            'styles': [style.strip() for style in record["Styles"].split(",") if style.strip()]
+        }
+        if record.get("Custom Fee", "").strip():
+            item_info['custom_fee'] = int(record["Custom Fee"])
+        if record.get("Hand Painted Fee", "").strip():
+            item_info['handpainted_fee'] = int(record["Hand Painted Fee"])
+        items[item_name] = item_info
+
+    if not items:
+        raise ValueError(f"worksheet '{PRODUCTS_SHEET_NAME}' has no products")
+    return items
+
+
+class CatalogStore:
+    """Per-process catalog, reloaded only when the spreadsheet revision changes
+
+    A Drive metadata lookup of the spreadsheet's modifiedTime is the cheap revision check.
+    When it changes the Products sheet is read, and the catalog is rebuilt only if its
+    rows differ. If the sheet cannot be read the last good catalog stays in use.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._catalog = None
+        self._values = None
+        self._revision = None
+        self._last_check = None
+        self.last_error = None
+
+    def get(self):
+        """Return the current catalog, checking the spreadsheet revision at most once per interval"""
+        if (self._catalog is not None and self._last_check is not None
+                and time.monotonic() - self._last_check < CATALOG_CHECK_INTERVAL):
+            return self._catalog
+        if not self._lock.acquire(blocking=False):
+            return self._catalog or self._fallback()  # Another session is already refreshing
+
+        try:
+            self._last_check = time.monotonic()
+            self._refresh()
+            self.last_error = None
+        except Exception as e:
+            self.last_error = f"{type(e).__name__}: {e}"
+            if self._catalog is None:
+                self._catalog = self._fallback()
+        finally:
+            self._lock.release()
+        return self._catalog
+
+    def _refresh(self):
+        if gc is None:
+            raise RuntimeError("Google Sheets client is not initialized")
+
+        spreadsheet_id = st.secrets["connections"]["gsheets"]["spreadsheet"]
+        revision = gc.get_file_drive_metadata(spreadsheet_id)["modifiedTime"]
+        if self._values is not None and revision == self._revision:
+            return
+
+        # Failures end up in last_error for admins, not on the shopper's page
+        worksheet = get_worksheet(PRODUCTS_SHEET_NAME, show_errors=False)
+
+        values = worksheet.get_all_values()
+        if values != self._values:
+            self._catalog = build_catalog(parse_products(values))
+            self._values = values
+            # Keep the last good sheet contents so a cold start can use them if Sheets is down
+            shared_cache.put_snapshot(PRODUCTS_SHEET_NAME, shared_cache.version(PRODUCTS_SHEET_NAME), values)
+        self._revision = revision
+
+    def _fallback(self):
+        """Last good Products snapshot from the shared cache, else the built-in catalog"""
+        try:
+            values = shared_cache.get_snapshot(PRODUCTS_SHEET_NAME, shared_cache.version(PRODUCTS_SHEET_NAME),
+                                               float("inf"))
+            if values:
+                return build_catalog(parse_products(values))
+        except Exception:
+            pass
+        return build_catalog(default_tumbler_items)
+
+
+@st.cache_resource
+def get_catalog_store():
+    """Shared catalog store for every session in this process"""
+    return CatalogStore()
+
+
+catalog_store = get_catalog_store()
+catalog = catalog_store.get()
+tumbler_items = catalog.items
+
+ORDER_DATE_FORMAT = "%d-%B-%Y"
+ORDER_STATUSES = ["Pending", "Processing", "Shipped", "Delivered", "Cancelled"]
+EXPORT_CHUNK_SIZE = 500
+
 month_list = list(calendar.month_name)[1:]
 current_month = datetime.today().month
 current_month_name = calendar.month_name[current_month]
@@ -113,37 +668,37 @@ def format_phone_number(phone):
 
 
 def generate_order_number():
-    """Generate a unique order number using gspread"""
+    """Generate a unique order number using gspread; None if it cannot be determined safely"""
     try:
-        worksheet = get_worksheet()
-        if worksheet is None:
-            return "#TC00001"
-
-        raw_data = worksheet.get_all_values()
-        if not raw_data or len(raw_data) < 2:
-            # No data or only header exists
-            return "#TC00001"
-
-        headers = raw_data[0]
-        rows = raw_data[1:]
-        records = pd.DataFrame(rows, columns=headers)
+        # Read the sheet itself: replicas on other hosts do not share the local counter below
+        raw_data = get_sheet_values(fresh=True)
+        if raw_data is None:
+            # Without the existing orders any number could duplicate one, so block the checkout
+            st.error("Could not read existing orders to assign an order number.")
+            return None
 
         # Extract numeric parts from 'Order Number' column
         numeric_parts = []
-        if 'Order Number' in records.columns:
-            for order_num in records['Order Number']:
-                if isinstance(order_num, str) and order_num.startswith('#TC'):
-                    try:
-                        numeric_parts.append(int(order_num[3:]))
-                    except ValueError:
-                        continue
-
-        next_id = max(numeric_parts) + 1 if numeric_parts else 1
+        if raw_data and len(raw_data) >= 2:
+            headers = raw_data[0]
+            rows = raw_data[1:]
+            records = pd.DataFrame(rows, columns=headers)
+
+            if 'Order Number' in records.columns:
+                for order_num in records['Order Number']:
+                    if isinstance(order_num, str) and order_num.startswith('#TC'):
+                        try:
+                            numeric_parts.append(int(order_num[3:]))
+                        except ValueError:
+                            continue
+
+        # The shared high-water mark stops two replicas on this host handing out the same number
+        next_id = shared_cache.next_counter("order_number", max(numeric_parts, default=0))
         return f"#TC{str(next_id).zfill(5)}"
 
     except Exception as e:
-        st.warning(f"Could not determine last order number: {e}")
-        return "#TC00001"
+        st.error(f"Could not determine the next order number: {e}")
+        return None
 
 
 def send_email(subject, body, to_email):
@@ -177,7 +732,7 @@ def add_orders_to_gsheet(orders_data):
             return False
 
         # Get existing data
-        existing_records_raw = worksheet.get_all_values()
+        existing_records_raw = get_sheet_values(fresh=True)
         if not existing_records_raw:
             existing_records = pd.DataFrame()
             headers = list(orders_data[0].keys())
@@ -213,9 +768,8 @@ def add_orders_to_gsheet(orders_data):
         if new_rows:
             worksheet.append_rows(new_rows)
 
-        # Optional: Clear function cache (if using @lru_cache)
-        if hasattr(get_worksheet, "cache_clear"):
-            get_worksheet.cache_clear()
+        # Let every replica know its snapshot of the orders sheet is out of date
+        shared_cache.invalidate(ORDERS_SHEET_NAME)
 
         return True
 
@@ -227,12 +781,8 @@ def add_orders_to_gsheet(orders_data):
 def get_orders(month=None):
     """Retrieve orders optionally filtered by month using gspread"""
     try:
-        worksheet = get_worksheet()
-        if worksheet is None:
-            return pd.DataFrame()
-
         # Get all records
-        records = worksheet.get_all_values()
+        records = get_sheet_values()
 
         if not records:
             return pd.DataFrame()
@@ -259,12 +809,12 @@ def get_orders(month=None):
 def count_orders():
     """Count total number of orders using gspread"""
     try:
-        worksheet = get_worksheet()
-        if worksheet is None:
+        records = get_sheet_values()
+        if records is None:
             return 0
 
         # Get the number of rows (minus header)
-        row_count = len(worksheet.get_all_values())
+        row_count = len(records)
         return max(0, row_count - 1)  # Subtract 1 for header row
 
     except Exception as e:
@@ -272,6 +822,109 @@ def count_orders():
         return 0
 
 
+def iter_order_chunks(worksheet, headers, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield order rows in fixed-size row ranges instead of reading the whole sheet at once"""
+    last_column = re.sub(r'\d', '', gspread.utils.rowcol_to_a1(1, len(headers)))
+    # The Sheets API trims trailing empty rows from a range, so a short chunk does not mean the
+    # sheet has ended; walk every row in the grid instead
+    last_row = worksheet.row_count
+
+    for start_row in range(2, last_row + 1, chunk_size):  # Row 1 is the header
+        end_row = min(start_row + chunk_size - 1, last_row)
+        rows = worksheet.get(f"A{start_row}:{last_column}{end_row}")
+
+        # Skip cleared rows and pad the rest, since trailing empty cells are trimmed too
+        rows = [row + [''] * (len(headers) - len(row)) for row in rows if any(row)]
+        if rows:
+            yield rows
+
+
+def filter_order_chunks(chunks, headers, start_date=None, end_date=None, statuses=None):
+    """Apply order date and status filters to each chunk of order rows"""
+    date_index = headers.index("Order Date") if "Order Date" in headers else None
+    status_index = headers.index("Status") if "Status" in headers else None
+
+    for rows in chunks:
+        filtered_rows = []
+        for row in rows:
+            if (start_date or end_date) and date_index is not None:
+                try:
+                    order_date = datetime.strptime(row[date_index], ORDER_DATE_FORMAT).date()
+                except ValueError:
+                    continue
+                if start_date and order_date < start_date:
+                    continue
+                if end_date and order_date > end_date:
+                    continue
+
+            if statuses and status_index is not None and row[status_index] not in statuses:
+                continue
+
+            filtered_rows.append(row)
+
+        if filtered_rows:
+            yield filtered_rows
+
+
+def write_orders_csv(chunks, headers, export_file):
+    """Stream order chunks into a CSV file"""
+    text_file = io.TextIOWrapper(export_file, encoding="utf-8", newline="")
+    writer = csv.writer(text_file)
+    writer.writerow(headers)
+    row_count = 0
+    for rows in chunks:
+        writer.writerows(rows)
+        row_count += len(rows)
+    text_file.flush()
+    text_file.detach()
+    return row_count
+
+
+def write_orders_parquet(chunks, headers, export_file):
+    """Stream order chunks into a Parquet file, one row group per chunk"""
+    schema = pa.schema([(header, pa.string()) for header in headers])
+    row_count = 0
+    with pq.ParquetWriter(export_file, schema) as writer:
+        for rows in chunks:
+            columns = [list(column) for column in zip(*rows)]
+            writer.write_table(pa.Table.from_arrays(columns, schema=schema))
+            row_count += len(rows)
+    return row_count
+
+
+def export_orders(file_format, start_date=None, end_date=None, statuses=None):
+    """Export filtered order history to a temporary CSV or Parquet file and return its path"""
+    try:
+        worksheet = get_worksheet()
+        if worksheet is None:
+            return None, 0
+
+        headers = worksheet.row_values(1)
+        if not headers:
+            return None, 0
+
+        chunks = filter_order_chunks(iter_order_chunks(worksheet, headers), headers, start_date, end_date, statuses)
+
+        suffix = ".csv" if file_format == "CSV" else ".parquet"
+        with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as export_file:
+            try:
+                if file_format == "CSV":
+                    row_count = write_orders_csv(chunks, headers, export_file)
+                else:
+                    row_count = write_orders_parquet(chunks, headers, export_file)
+            except Exception:
+                # Never leave a partial export with customer details behind in the temp dir
+                export_file.close()
+                os.remove(export_file.name)
+                raise
+
+        return export_file.name, row_count
+
+    except Exception as e:
+        st.error(f"Failed to export orders: {e}")
+        return None, 0
+
+
 def has_custom_or_hand_painted_items():
     """Check if cart contains any custom or hand-painted items"""
     for item in st.session_state.cart.values():
@@ -280,57 +933,68 @@ def has_custom_or_hand_painted_items():
     return False
 
 
-def get_item_price(base_price, style):
-    """Calculate item price including any extra fees for custom/hand-painted styles"""
-    if style == "Custom":
-        return base_price + CUSTOM_FEE
-    elif style == "Hand Painted":
-        return base_price + HANDPAINTED_FEE
-    return base_price
+def get_cart_stock_items():
+    """Return the cart as (item, style, quantity) lines for stock reservation"""
+    return [(item['name'], item['style'], item['quantity']) for item in st.session_state.cart.values()]
 
 
-def get_style_fee(style):
-    """Return the additional fee for a specific style"""
-    if style == "Custom":
-        return CUSTOM_FEE
-    elif style == "Hand Painted":
-        return HANDPAINTED_FEE
-    return 0
+def reserve_cart_stock():
+    """Reserve stock for everything in the cart, reporting any items that ran out"""
+    if not stock_ledger.ready:
+        # The counters are empty until a sync succeeds; load them now instead of selling unchecked
+        stock_ledger.sync(force=True)
+    if not stock_ledger.ready:
+        st.error("We couldn't check stock levels right now. Please try again in a moment.")
+        return False
 
+    shortfalls = stock_ledger.reserve(get_cart_stock_items())
+    for item_name, style, available in shortfalls:
+        if available > 0:
+            st.error(f"Only {available} {item_name} ({style}) left in stock.")
+        else:
+            st.error(f"{item_name} ({style}) is out of stock.")
+    return not shortfalls
 
-st.markdown("""
-    <style>
-        .title {
-            text-align: center;
-            color: orange;
-            font-size: 48px;
-            font-weight: bold;
-        }
-        .quote {
-            text-align: center;
-            font-size: 24px;
-            font-style: italic;
-            color: #6c757d;
-            margin-top: 10px;
-        }
-    </style>
-""", unsafe_allow_html=True)
 
-st.markdown("<div class='title'>Order Tumble Cup</div>", unsafe_allow_html=True)
+def get_item_price(item_name, style):
+    """Look up the item price including any extra fees for custom/hand-painted styles"""
+    return catalog.prices[(item_name, style)]
 
-image = Image.open("Tumblecup.jpeg")
-left_co, cent_co, right_co = st.columns([1, 2, 1])
-with cent_co:
-    st.image(image, width=1000)
 
-# Motivational Quote
-st.markdown("<div class='quote'>“Hydrate and glow – your body will thank you.”</div>", unsafe_allow_html=True)
+def get_style_fee(item_name, style):
+    """Return the additional fee for a specific item and style"""
+    return catalog.fees[(item_name, style)]
 
-tab1, tab2, tab3 = st.tabs(["Shop Items", "Cart", "Checkout"])
 
-# Shop Items Tab
-with tab1:
-    st.header("Add Items to Cart")
+def reprice_cart():
+    """Bring cart prices in line with the current catalog and describe anything that changed"""
+    changes = []
+    for item_key, item_data in list(st.session_state.cart.items()):
+        price = catalog.prices.get((item_data['name'], item_data['style']))
+        if price is None:
+            del st.session_state.cart[item_key]
+            changes.append(f"{item_key} is no longer available and was removed from your cart.")
+        elif price != item_data['price']:
+            changes.append(f"The price of {item_key} changed from Rs. {item_data['price']} to Rs. {price}.")
+            item_data['price'] = price
+            item_data['base_price'] = catalog.items[item_data['name']]['price']
+            item_data['style_fee'] = get_style_fee(item_data['name'], item_data['style'])
+    return changes
+
+
+@st.cache_resource
+def load_hero_image():
+    """Load the hero image once per process instead of on every rerun"""
+    # Decode fully and close the file, since every session thread shares the cached image
+    with Image.open("Tumblecup.jpeg") as hero_image:
+        return hero_image.copy()
+
+
+@st.fragment
+def shop_items():
+    """Product grid; style and quantity changes rerun only this fragment"""
+    if "cart_notice" in st.session_state:
+        st.success(st.session_state.pop("cart_notice"))
 
     for item_name, item_info in tumbler_items.items():
         col1, col2, col3, col4 = st.columns([3, 2, 1, 1])
@@ -338,7 +1002,7 @@ with tab1:
         with col1:
             st.write(f"**{item_name}**")
             st.write(
-                f"Price: Rs. {item_info['price']} (+ Rs. {CUSTOM_FEE} for Custom, + Rs. {HANDPAINTED_FEE} for Hand Painted)")
+                f"Price: Rs. {item_info['price']} (+ Rs. {item_info['custom_fee']} for Custom, + Rs. {item_info['handpainted_fee']} for Hand Painted)")
 
         with col2:
             style = st.selectbox(
@@ -347,14 +1011,23 @@ with tab1:
                 key=f"style_{item_name}"
             )
 
+            available = stock_ledger.available(item_name, style)
+            if available is not None:
+                st.caption(f"In stock: {available}" if available > 0 else "Out of stock")
+
         with col3:
             quantity = st.number_input(f"Qty", min_value=1, value=1, key=f"qty_{item_name}", step=1)
 
         with col4:
-            if st.button("Add to Cart", key=f"add_{item_name}"):
-                item_price = get_item_price(item_info['price'], style)
+            if st.button("Add to Cart", key=f"add_{item_name}", disabled=available is not None and available <= 0):
+                item_price = get_item_price(item_name, style)
                 item_key = f"{item_name} ({style})"
 
+                in_cart = st.session_state.cart.get(item_key, {}).get('quantity', 0)
+                if available is not None and in_cart + quantity > available:
+                    st.warning(f"Only {available} {item_name} ({style}) left in stock.")
+                    return
+
                 if item_key in st.session_state.cart:
                     st.session_state.cart[item_key]['quantity'] += quantity
                 else:
@@ -363,12 +1036,210 @@ with tab1:
                         'style': style,
                         'price': item_price,
                         'base_price': item_info['price'],
-                        'style_fee': get_style_fee(style),
+                        'style_fee': get_style_fee(item_name, style),
                         'has_custom_fee': style == "Custom",
                         'has_handpainted_fee': style == "Hand Painted",
                         'quantity': quantity
                     }
-                st.success(f"Added {quantity} {item_name} ({style}) to cart!")
+                # The cart is shown in every tab, so refresh the whole app once the cart changes
+                st.session_state.cart_notice = f"Added {quantity} {item_name} ({style}) to cart!"
+                st.rerun(scope="app")
+
+
+@st.fragment
+def cart_view(key_prefix=""):
+    """Cart contents; Remove and Clear Cart rerun this fragment before refreshing the app"""
+    if not st.session_state.cart:
+        st.info("Your cart is empty. Add some items!")
+        return
+
+    total_cart_price = 0
+    for item_key, item_data in st.session_state.cart.items():
+        item_total = item_data['price'] * item_data['quantity']
+        total_cart_price += item_total
+
+        col1, col2, col3, col4 = st.columns([3, 1, 1, 1])
+        with col1:
+            display_name = f"{item_key}"
+            if item_data['has_custom_fee']:
+                display_name += f" (Includes Rs. {item_data['style_fee']} custom fee)"
+            elif item_data['has_handpainted_fee']:
+                display_name += f" (Includes Rs. {item_data['style_fee']} hand-painted fee)"
+            st.write(f"**{display_name}**")
+        with col2:
+            st.write(f"Qty: {item_data['quantity']}")
+        with col3:
+            st.write(f"Rs. {item_total}")
+        with col4:
+            if st.button("Remove", key=f"{key_prefix}remove_{item_key}"):
+                del st.session_state.cart[item_key]
+                st.rerun(scope="app")
+
+    st.write(f"**Total: Rs. {total_cart_price}**")
+
+    if st.button("Clear Cart", key=f"{key_prefix}clear"):
+        st.session_state.cart = {}
+        st.info("Your Cart has been Cleared!")
+        time.sleep(0.5)
+        st.rerun(scope="app")
+
+
+@st.fragment
+def payment_details():
+    """Payment method and account details; switching methods reruns only this fragment"""
+    mobile_money_accounts = {
+        "JazzCash": f"{st.secrets['Banking']['Phone']}",
+        "EasyPaisa": f"{st.secrets['Banking']['Phone']}",
+        "Raast": f"{st.secrets['Banking']['Phone']}"
+    }
+
+    bank_transfer_details = {
+        "Bank Name": "HBL",
+        "Account Title": "TOOBA",
+        "Account Number": f"{st.secrets['Banking']['Account']}",
+        "IBAN": f"{st.secrets['Banking']['IBAN']}"
+    }
+
+    st.markdown('<p class="required">Payment Method</p>', unsafe_allow_html=True)
+    payment_method = st.selectbox(
+        "",
+        ["Cash on Delivery", "Mobile Money (Jazzcash etc)", "Bank Transfer"],
+        index=0,
+        key="payment_method"
+    )
+
+    if payment_method == "Mobile Money (Jazzcash etc)":
+        st.subheader("Mobile Money Account Details")
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            st.info("JazzCash: " + mobile_money_accounts["JazzCash"])
+        with col2:
+            st.info("EasyPaisa: " + mobile_money_accounts["EasyPaisa"])
+        with col3:
+            st.info("Raast: " + mobile_money_accounts["Raast"])
+
+        st.markdown('<p class="required">Select Mobile Money Service Used:</p>', unsafe_allow_html=True)
+        mobile_service = st.radio("Mobile Service", ["JazzCash", "EasyPaisa", "Raast", "Other"], key="mobile_service")
+        if mobile_service == "Other":
+            st.markdown('<p class="required">Specify Service:</p>', unsafe_allow_html=True)
+            st.text_input("", placeholder="Enter mobile money service name", key="other_service")
+
+        st.markdown('<p class="required">Transaction ID:</p>', unsafe_allow_html=True)
+        st.text_input("Transaction ID", placeholder="Enter transaction ID", key="transaction_id")
+
+    elif payment_method == "Bank Transfer":
+        st.subheader("Bank Transfer Details")
+        st.info(f"""
+        **Bank Name:** {bank_transfer_details['Bank Name']}  
+        **Account Title:** {bank_transfer_details['Account Title']}  
+        **Account Number:** {bank_transfer_details['Account Number']}  
+        **IBAN:** {bank_transfer_details['IBAN']}
+        """)
+        st.markdown('<p class="required">Transaction Reference:</p>', unsafe_allow_html=True)
+        st.text_input("", placeholder="Enter bank transfer reference", key="transaction_ref")
+
+
+def get_selected_payment():
+    """Read the payment fragment's widget values from session state"""
+    payment_method = st.session_state.get("payment_method", "Cash on Delivery")
+
+    if payment_method == "Mobile Money (Jazzcash etc)":
+        mobile_service = st.session_state.get("mobile_service")
+        if mobile_service == "Other":
+            payment_service = st.session_state.get("other_service")
+        else:
+            payment_service = mobile_service
+        return payment_method, payment_service, st.session_state.get("transaction_id")
+
+    if payment_method == "Bank Transfer":
+        return payment_method, "Bank Transfer", st.session_state.get("transaction_ref")
+
+    return payment_method, None, None
+
+
+st.markdown("""
+    <style>
+        .title {
+            text-align: center;
+            color: orange;
+            font-size: 48px;
+            font-weight: bold;
+        }
+        .quote {
+            text-align: center;
+            font-size: 24px;
+            font-style: italic;
+            color: #6c757d;
+            margin-top: 10px;
+        }
+    </style>
+""", unsafe_allow_html=True)
+
+st.markdown("<div class='title'>Order Tumble Cup</div>", unsafe_allow_html=True)
+
+image = load_hero_image()
+left_co, cent_co, right_co = st.columns([1, 2, 1])
+with cent_co:
+    st.image(image, width=1000)
+
+# Motivational Quote
+st.markdown("<div class='quote'>“Hydrate and glow – your body will thank you.”</div>", unsafe_allow_html=True)
+
+# Accounting Export, only offered when an admin password is configured
+expected_admin_password = st.secrets.get("Admin", {}).get("Password")
+if expected_admin_password:
+    with st.sidebar:
+        st.header("Accounting Export")
+        admin_password = st.text_input("Admin Password", type="password", key="admin_password")
+
+        if admin_password and admin_password == expected_admin_password:
+            if sheets_session is not None:
+                with st.expander("Sheets Connection"):
+                    st.json(sheets_session.metrics())
+
+            if stock_ledger.last_error:
+                st.warning(f"Stock levels not synced: {stock_ledger.last_error}")
+
+            if catalog_store.last_error:
+                st.warning(f"Catalog not refreshed, using last good prices: {catalog_store.last_error}")
+
+            export_format = st.radio("Format", ["CSV", "Parquet"], horizontal=True, key="export_format")
+            export_start = st.date_input("From", value=None, key="export_start")
+            export_end = st.date_input("To", value=None, key="export_end")
+            export_statuses = st.multiselect("Status", ORDER_STATUSES, key="export_statuses",
+                                             help="Leave empty to include every status")
+
+            if st.button("Prepare Export", key="prepare_export"):
+                with st.spinner("Exporting orders..."):
+                    export_path, exported_rows = export_orders(export_format, export_start, export_end,
+                                                               export_statuses)
+
+                if export_path:
+                    try:
+                        with open(export_path, "rb") as export_file:
+                            st.download_button(
+                                f"Download {exported_rows} order row(s)",
+                                data=export_file,
+                                file_name=f"tumblecup_orders_{datetime.today().strftime('%Y%m%d')}"
+                                          f"{'.csv' if export_format == 'CSV' else '.parquet'}",
+                                mime="text/csv" if export_format == "CSV" else "application/octet-stream",
+                                key="download_export"
+                            )
+                    finally:
+                        os.remove(export_path)
+        elif admin_password:
+            st.error("Incorrect password.")
+
+# Prices may have been reloaded from the Products sheet since items were added
+cart_price_changes = reprice_cart()
+
+tab1, tab2, tab3 = st.tabs(["Shop Items", "Cart", "Checkout"])
+
+# Shop Items Tab
+with tab1:
+    st.header("Add Items to Cart")
+
+    shop_items()
 
     st.divider()
     total_items = sum(item['quantity'] for item in st.session_state.cart.values())
@@ -376,39 +1247,7 @@ with tab1:
 
     if st.session_state.cart:
         st.subheader("Current Cart")
-
-        total_cart_price = 0
-        for item_key, item_data in st.session_state.cart.items():
-            item_total = item_data['price'] * item_data['quantity']
-            total_cart_price += item_total
-
-            col1, col2, col3, col4 = st.columns([3, 1, 1, 1])
-            with col1:
-                display_name = f"{item_key}"
-                if item_data['has_custom_fee']:
-                    display_name += f" (Includes Rs. {CUSTOM_FEE} custom fee)"
-                elif item_data['has_handpainted_fee']:
-                    display_name += f" (Includes Rs. {HANDPAINTED_FEE} hand-painted fee)"
-                st.write(f"**{display_name}**")
-            with col2:
-                st.write(f"Qty: {item_data['quantity']}")
-            with col3:
-                st.write(f"Rs. {item_total}")
-            with col4:
-                if st.button("Remove", key=f"remove_{item_key}"):
-                    del st.session_state.cart[item_key]
-                    time.sleep(0.5)
-                    st.rerun()
-
-        st.write(f"**Total: Rs. {total_cart_price}**")
-
-        if st.button("Clear Cart"):
-            st.session_state.cart = {}
-            st.info("Emptying your cart.....")
-            time.sleep(2)
-            st.rerun("app")
-    else:
-        st.info("Your cart is empty. Add some items!")
+    cart_view()
 
 # Custom CSS
 st.markdown("""
@@ -430,40 +1269,12 @@ with tab2:
     st.header("Cart")
     if st.session_state.cart:
         st.subheader("Current Cart")
-
-        total_cart_price = 0
-        for item_key, item_data in st.session_state.cart.items():
-            item_total = item_data['price'] * item_data['quantity']
-            total_cart_price += item_total
-
-            col1, col2, col3, col4 = st.columns([3, 1, 1, 1])
-            with col1:
-                display_name = f"{item_key}"
-                if item_data['has_custom_fee']:
-                    display_name += f" (Includes Rs. {CUSTOM_FEE} custom fee)"
-                elif item_data['has_handpainted_fee']:
-                    display_name += f" (Includes Rs. {HANDPAINTED_FEE} hand-painted fee)"
-                st.write(f"**{display_name}**")
-            with col2:
-                st.write(f"Qty: {item_data['quantity']}")
-            with col3:
-                st.write(f"Rs. {item_total}")
-            with col4:
-                if st.button("Remove", key=f"tab2_remove_{item_key}"):
-                    del st.session_state.cart[item_key]
-                    st.rerun()
-
-        st.write(f"**Total: Rs. {total_cart_price}**")
-
-        if st.button("Clear Cart", key="tab2_clear"):
-            st.session_state.cart = {}
-            st.info("Your Cart has been Cleared!")
-            time.sleep(0.5)
-            st.rerun()
-    else:
-        st.info("Your cart is empty. Add some items!")
+    cart_view(key_prefix="tab2_")
 
 with tab3:
+    for change in cart_price_changes:
+        st.warning(change)
+
     if not st.session_state.cart:
         st.warning("Your cart is empty. Please add items before proceeding to checkout.")
     else:
@@ -479,9 +1290,9 @@ with tab3:
 
             price_display = f"{item_key} × {item_data['quantity']} = Rs. {item_total}"
             if item_data['has_custom_fee']:
-                price_display += f" (Includes Rs. {CUSTOM_FEE} custom fee per item)"
+                price_display += f" (Includes Rs. {item_data['style_fee']} custom fee per item)"
             elif item_data['has_handpainted_fee']:
-                price_display += f" (Includes Rs. {HANDPAINTED_FEE} hand-painted fee per item)"
+                price_display += f" (Includes Rs. {item_data['style_fee']} hand-painted fee per item)"
             st.write(price_display)
 
             if item_data['style'] in ["Custom", "Hand Painted"]:
@@ -520,65 +1331,11 @@ with tab3:
             instructions = st.text_area("Instructions", placeholder="Enter any special delivery instructions",
                                         key="instructions_input")
 
-        order_date = datetime.today().strftime("%d-%B-%Y")
+        order_date = datetime.today().strftime(ORDER_DATE_FORMAT)
 
-        mobile_money_accounts = {
-            "JazzCash": f"{st.secrets['Banking']['Phone']}",
-            "EasyPaisa": f"{st.secrets['Banking']['Phone']}",
-            "Raast": f"{st.secrets['Banking']['Phone']}"
-        }
+        payment_details()
 
-        bank_transfer_details = {
-            "Bank Name": "HBL",
-            "Account Title": "TOOBA",
-            "Account Number": f"{st.secrets['Banking']['Account']}",
-            "IBAN": f"{st.secrets['Banking']['IBAN']}"
-        }
-
-        st.markdown('<p class="required">Payment Method</p>', unsafe_allow_html=True)
-        payment_method = st.selectbox(
-            "",
-            ["Cash on Delivery", "Mobile Money (Jazzcash etc)", "Bank Transfer"],
-            index=0,
-            key="payment_method"
-        )
-
-        payment_service = None
-        transaction_id = None
-
-        if payment_method == "Mobile Money (Jazzcash etc)":
-            st.subheader("Mobile Money Account Details")
-            col1, col2, col3 = st.columns(3)
-            with col1:
-                st.info("JazzCash: " + mobile_money_accounts["JazzCash"])
-            with col2:
-                st.info("EasyPaisa: " + mobile_money_accounts["EasyPaisa"])
-            with col3:
-                st.info("Raast: " + mobile_money_accounts["Raast"])
-
-            st.markdown('<p class="required">Select Mobile Money Service Used:</p>', unsafe_allow_html=True)
-            mobile_service = st.radio("Mobile Service", ["JazzCash", "EasyPaisa", "Raast", "Other"], key="mobile_service")
-            if mobile_service == "Other":
-                st.markdown('<p class="required">Specify Service:</p>', unsafe_allow_html=True)
-                other_service = st.text_input("", placeholder="Enter mobile money service name", key="other_service")
-                payment_service = other_service
-            else:
-                payment_service = mobile_service
-
-            st.markdown('<p class="required">Transaction ID:</p>', unsafe_allow_html=True)
-            transaction_id = st.text_input("Transaction ID", placeholder="Enter transaction ID", key="transaction_id")
-
-        elif payment_method == "Bank Transfer":
-            st.subheader("Bank Transfer Details")
-            st.info(f"""
-            **Bank Name:** {bank_transfer_details['Bank Name']}  
-            **Account Title:** {bank_transfer_details['Account Title']}  
-            **Account Number:** {bank_transfer_details['Account Number']}  
-            **IBAN:** {bank_transfer_details['IBAN']}
-            """)
-            st.markdown('<p class="required">Transaction Reference:</p>', unsafe_allow_html=True)
-            transaction_id = st.text_input("", placeholder="Enter bank transfer reference", key="transaction_ref")
-            payment_service = "Bank Transfer"
+        payment_method, payment_service, transaction_id = get_selected_payment()
 
         submit_button = st.button("Place Order")
 
@@ -609,7 +1366,7 @@ with tab3:
 
                 # Payment method validation
                 if payment_method == "Mobile Money (Jazzcash etc)":
-                    if mobile_service == "Other" and not payment_service:
+                    if st.session_state.get("mobile_service") == "Other" and not payment_service:
                         missing_fields.append("Mobile Money Service")
                     if not transaction_id:
                         missing_fields.append("Transaction ID")
@@ -623,6 +1380,10 @@ with tab3:
                 elif validation_errors:
                     for error in validation_errors:
                         st.error(error)
+                elif cart_price_changes:
+                    st.warning("Prices in your cart have changed. Please review the updated total and place your order again.")
+                elif not reserve_cart_stock():
+                    st.warning("Please update your cart and try again.")
                 else:
                     formatted_phone = format_phone_number(phone)
                     order_number = generate_order_number()
@@ -636,9 +1397,9 @@ with tab3:
 
                         price_display = f"Rs. {item_data['price']}"
                         if item_data['has_custom_fee']:
-                            price_display = f"Rs. {item_data['base_price']} + Rs. {CUSTOM_FEE} (custom)"
+                            price_display = f"Rs. {item_data['base_price']} + Rs. {item_data['style_fee']} (custom)"
                         elif item_data['has_handpainted_fee']:
-                            price_display = f"Rs. {item_data['base_price']} + Rs. {HANDPAINTED_FEE} (hand-painted)"
+                            price_display = f"Rs. {item_data['base_price']} + Rs. {item_data['style_fee']} (hand-painted)"
 
                         order_rows += f"""
                             <tr>
@@ -652,10 +1413,10 @@ with tab3:
                         style_fee = 0
                         fee_type = ""
                         if item_data['has_custom_fee']:
-                            style_fee = CUSTOM_FEE
+                            style_fee = item_data['style_fee']
                             fee_type = "Custom Fee"
                         elif item_data['has_handpainted_fee']:
-                            style_fee = HANDPAINTED_FEE
+                            style_fee = item_data['style_fee']
                             fee_type = "Hand-Painted Fee"
 
                         order_data = {
@@ -688,7 +1449,7 @@ with tab3:
                         all_order_data.append(order_data)
 
                     try:
-                        if add_orders_to_gsheet(all_order_data):
+                        if order_number is not None and add_orders_to_gsheet(all_order_data):
                             successful_items = len(all_order_data)
                         else:
                             successful_items = 0
@@ -770,9 +1531,9 @@ with tab3:
                             for item_key, item_data in st.session_state.cart.items():
                                 price_display = f"**{item_key}:** {item_data['quantity']} × Rs. {item_data['price']}"
                                 if item_data['has_custom_fee']:
-                                    price_display += f" (includes Rs. {CUSTOM_FEE} custom fee per item)"
+                                    price_display += f" (includes Rs. {item_data['style_fee']} custom fee per item)"
                                 elif item_data['has_handpainted_fee']:
-                                    price_display += f" (includes Rs. {HANDPAINTED_FEE} hand-painted fee per item)"
+                                    price_display += f" (includes Rs. {item_data['style_fee']} hand-painted fee per item)"
                                 price_display += f" = Rs. {item_data['price'] * item_data['quantity']}"
                                 st.write(price_display)
                             st.write(f"**Total:** Rs. {cart_total}")
@@ -787,6 +1548,7 @@ with tab3:
                         time.sleep(5)
                         st.rerun(scope="app")
                     else:
+                        stock_ledger.release(get_cart_stock_items())
                         st.error("Failed to submit any items in your order. Please try again.")
                         time.sleep(5)
                         st.rerun(scope="app")
@@ -0,0 +1,123 @@
+"""Per-interaction script time for the shop and payment sections of App.py
+
+Streamlit's AppTest always executes the whole script, even for widgets inside a
+fragment. This script therefore times two things on an instrumented copy of the app:
+
+  * the whole script run, which is what every interaction costs without fragments
+  * the shop_items() / payment_details() fragment bodies, which is what a
+    fragment-scoped rerun executes in a real session
+
+Run it from the repository root, against the current app and an older revision:
+
+    python benchmarks/fragment_timing.py
+    git show ee2b0ba:App.py > /tmp/App_before.py
+    python benchmarks/fragment_timing.py --app /tmp/App_before.py
+"""
+import argparse
+import os
+import statistics
+import tempfile
+
+from streamlit.testing.v1 import AppTest
+
+SECRETS = {
+    "connections": {"gsheets": {key: "benchmark" for key in [
+        "type", "project_id", "private_key_id", "private_key", "client_email", "client_id", "auth_uri",
+        "token_uri", "auth_provider_x509_cert_url", "client_x509_cert_url", "spreadsheet"
+    ]}},
+    "Banking": {"Phone": "03000000000", "Account": "0000", "IBAN": "PK00BENCH"},
+    "Email": {"Password": "benchmark"}
+}
+
+CART = {
+    "Can Glass (Style 1)": {
+        'name': "Can Glass", 'style': "Style 1", 'price': 1999, 'base_price': 1999, 'style_fee': 0,
+        'has_custom_fee': False, 'has_handpainted_fee': False, 'quantity': 1
+    }
+}
+
+# Each timed section is written to the timings file as "<label> <seconds>"
+TIMER = "_bench_t.perf_counter()"
+RECORD = "open({path!r}, 'a').write(f'{label} {{_bench_t.perf_counter() - {start}}}\\n')"
+
+
+def instrument(source, timings_path):
+    """Wrap the whole script and any fragment calls in perf_counter timers"""
+    record = RECORD.format(path=timings_path, label="script", start="_bench_script_start")
+    source = f"import time as _bench_t\n_bench_script_start = {TIMER}\n{source}\n{record}\n"
+
+    for fragment in ("shop_items", "payment_details"):
+        for indent in ("    ", "        "):
+            call = f"\n{indent}{fragment}()\n"
+            record = RECORD.format(path=timings_path, label=fragment, start="_bench_start")
+            source = source.replace(call, f"\n{indent}_bench_start = {TIMER}; {fragment}(); {record}\n")
+    return source
+
+
+def read_timings(timings_path):
+    timings = {}
+    with open(timings_path) as timings_file:
+        for line in timings_file:
+            label, seconds = line.split()
+            timings.setdefault(label, []).append(float(seconds) * 1000)
+    return timings
+
+
+def run_interaction(app_path, interact, iterations):
+    """Repeat one widget interaction and return median milliseconds per timed section"""
+    with open(app_path, encoding="utf-8") as app_file:
+        source = app_file.read()
+
+    timings_path = tempfile.mktemp(suffix=".txt")
+    # Keep the instrumented copy in the working directory so relative asset paths still resolve
+    fd, script_path = tempfile.mkstemp(suffix=".py", dir=os.getcwd())
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as script_file:
+            script_file.write(instrument(source, timings_path))
+
+        at = AppTest.from_file(script_path, default_timeout=60)
+        for key, value in SECRETS.items():
+            at.secrets[key] = value
+        at.run()
+        at.session_state.cart = dict(CART)
+        at.run()
+
+        if os.path.exists(timings_path):
+            os.remove(timings_path)  # Only keep the timed interactions
+        for i in range(iterations):
+            interact(at, i)
+
+        timings = read_timings(timings_path)
+        return {label: statistics.median(values) for label, values in timings.items()}
+    finally:
+        os.remove(script_path)
+        if os.path.exists(timings_path):
+            os.remove(timings_path)
+
+
+def change_style(at, i):
+    at.selectbox(key="style_Classic Tumbler").set_value(["Style 2", "Style 3", "Style 1"][i % 3]).run()
+
+
+def switch_payment(at, i):
+    methods = ["Mobile Money (Jazzcash etc)", "Bank Transfer", "Cash on Delivery"]
+    at.selectbox(key="payment_method").set_value(methods[i % 3]).run()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--app", default="App.py", help="app script to measure")
+    parser.add_argument("--iterations", type=int, default=30)
+    args = parser.parse_args()
+
+    for name, interact, fragment in [("style change", change_style, "shop_items"),
+                                     ("payment switch", switch_payment, "payment_details")]:
+        medians = run_interaction(args.app, interact, args.iterations)
+        line = f"{name}: whole script {medians['script']:.1f} ms"
+        if fragment in medians:
+            line += f", {fragment}() fragment {medians[fragment]:.1f} ms"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
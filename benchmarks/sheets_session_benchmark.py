@@ -0,0 +1,173 @@
+"""Handshake time saved by SheetsSession's pooled keep-alive connections
+
+Starts a local HTTPS stand-in for the Google APIs (self-signed certificate, a token
+endpoint and a values endpoint), then times the same GET two ways:
+
+  * a new requests.Session per call, i.e. a new TCP + TLS handshake every time
+  * App.py's SheetsSession, which keeps the connection open between calls
+
+It also lets SheetsSession's background thread refresh a short-lived token and reports
+the refresh timings from SheetsSession.metrics().
+
+App.py is a Streamlit script that draws the UI when imported, so the SheetsSession class
+and the constants it uses are read out of its source instead.
+
+    python benchmarks/sheets_session_benchmark.py
+"""
+import argparse
+import ast
+import datetime
+import json
+import os
+import ssl
+import statistics
+import tempfile
+import threading
+import time
+from datetime import timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from google.auth import credentials as google_credentials
+from google.auth.transport.requests import AuthorizedSession, Request
+from requests.adapters import HTTPAdapter
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "App.py")
+TOKEN_DELAY = 0.05  # Seconds the stand-in token endpoint takes, like a real OAuth round trip
+
+
+def load_sheets_session(**overrides):
+    """Build the SheetsSession class from App.py's source"""
+    with open(APP_PATH, encoding="utf-8") as app_file:
+        tree = ast.parse(app_file.read())
+
+    namespace = {
+        "threading": threading, "time": time, "datetime": datetime.datetime, "timezone": timezone,
+        "requests": requests, "HTTPAdapter": HTTPAdapter, "AuthorizedSession": AuthorizedSession, "Request": Request
+    }
+    for node in tree.body:
+        is_constant = isinstance(node, ast.Assign) and getattr(node.targets[0], "id", "") in (
+            "HTTP_POOL_SIZE", "TOKEN_REFRESH_MARGIN", "TOKEN_REFRESH_RETRY")
+        if is_constant or (isinstance(node, ast.ClassDef) and node.name == "SheetsSession"):
+            exec(compile(ast.Module([node], []), APP_PATH, "exec"), namespace)
+    namespace.update(overrides)
+    return namespace["SheetsSession"]
+
+
+def write_self_signed_cert(directory):
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+    now = datetime.datetime.now(timezone.utc)
+    cert = (x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now).not_valid_after(now + datetime.timedelta(days=1))
+            .add_extension(x509.SubjectAlternativeName([x509.DNSName("localhost")]), critical=False)
+            .sign(key, hashes.SHA256()))
+
+    cert_path = os.path.join(directory, "cert.pem")
+    key_path = os.path.join(directory, "key.pem")
+    with open(cert_path, "wb") as cert_file:
+        cert_file.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, "wb") as key_file:
+        key_file.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                         serialization.NoEncryption()))
+    return cert_path, key_path
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    wbufsize = 65536  # Send headers and body together, avoiding delayed-ACK stalls on keep-alive
+
+    def do_GET(self):
+        self._send({"range": "Tumble_cup!A1:B1", "values": [["Order Number", "Name"]]})
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(TOKEN_DELAY)
+        self._send({"access_token": f"token-{time.time()}", "expires_in": self.server.token_lifetime})
+
+    def _send(self, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInCredentials(google_credentials.Credentials):
+    """Credentials whose refresh calls the stand-in token endpoint"""
+
+    def __init__(self, token_url):
+        super().__init__()
+        self.token_url = token_url
+
+    def refresh(self, request):
+        response = request(url=self.token_url, method="POST", body=b"grant_type=stand-in", headers={})
+        data = json.loads(response.data)
+        self.token = data["access_token"]
+        self.expiry = (datetime.datetime.now(timezone.utc).replace(tzinfo=None)
+                       + datetime.timedelta(seconds=data["expires_in"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=100)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        cert_path, key_path = write_self_signed_cert(directory)
+        os.environ["REQUESTS_CA_BUNDLE"] = cert_path
+
+        server = ThreadingHTTPServer(("localhost", 0), StandInHandler)
+        server.token_lifetime = 3600
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert_path, key_path)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"https://localhost:{server.server_port}"
+        values_url = f"{base_url}/v4/spreadsheets/stand-in/values/Tumble_cup"
+
+        new_connection = []
+        for _ in range(args.calls):
+            started = time.perf_counter()
+            with requests.Session() as session:
+                session.get(values_url).raise_for_status()
+            new_connection.append(time.perf_counter() - started)
+
+        SheetsSession = load_sheets_session()
+        sheets_session = SheetsSession(StandInCredentials(f"{base_url}/token"))
+        pooled = []
+        for _ in range(args.calls):
+            started = time.perf_counter()
+            sheets_session.session.get(values_url).raise_for_status()
+            pooled.append(time.perf_counter() - started)
+
+        new_median = statistics.median(new_connection) * 1000
+        pooled_median = statistics.median(pooled) * 1000
+        print(f"new connection per call: median {new_median:.2f} ms")
+        print(f"pooled SheetsSession:    median {pooled_median:.2f} ms")
+        print(f"saved per call:          {new_median - pooled_median:.2f} ms")
+        print(json.dumps(sheets_session.metrics(), indent=2))
+
+        # A token that lives just past the refresh margin is renewed by the background thread
+        server.token_lifetime = 301
+        SheetsSession = load_sheets_session(TOKEN_REFRESH_RETRY=1)
+        short_lived = SheetsSession(StandInCredentials(f"{base_url}/token"))
+        short_lived.start_background_refresh()
+        time.sleep(3.5)
+        metrics = short_lived.metrics()
+        print(f"background refreshes in 3.5 s: {metrics['Token Refreshes'] - 1}, "
+              f"last took {metrics['Last Refresh (ms)']} ms off the request path")
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()